@@ -13,131 +13,295 @@ IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 or implied.
 """
 import sys, os
+import time
+import asyncio
 import meraki
+import meraki.aio
 import json
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from rich.console import Console
 from rich.panel import Panel
 from rich.progress import Progress
 
-def get_network_id(dashboard, org_id, net_name):
+SSID_NUMBER = 3 #the SSID configured will always be the 4th SSID (0-based index)
+CACHE_PATH = os.path.join(".meraki_cache", "ap_tags.json")
+CACHE_EXPIRY = 300 #seconds the AP tags retrieved by a previous run are reused
+
+def parse_network_names(network_names):
     """
-    Connect to the Meraki dashboard and retrieve the networks of the org
-    Then find the network id corresponding to the network name provided
-    in the environmental variables
-    :return: string containing the network id or None if no id found
+    Parse the JSON list of network names given in the environmental variables
+    :return: frozenset of the network names or None if the value is not a non-empty list of names
     """
-    networks = dashboard.organizations.getOrganizationNetworks(org_id,
-                                                              total_pages="all")
-    for network in networks:
-        if network["name"] == net_name:
-            return network["id"]
+    try:
+        names = json.loads(network_names or "[]")
+    except json.JSONDecodeError:
+        return None
+
+    if not isinstance(names, list) or not names:
+        return None
+    if not all(isinstance(name, str) for name in names):
+        return None
+
+    return frozenset(names)
+
+def configure_session(dashboard):
+    """
+    Mount a connection pool on the HTTP session the Meraki SDK uses, so every
+    API call reuses kept-alive TLS connections. Only failures to establish a
+    connection are retried here; read errors and HTTP status codes (including
+    429 and Retry-After) are left to the SDK's own retries
+    :return: the requests session of the dashboard
+    """
+    session = dashboard._session._req_session
+    retries = Retry(total=None, connect=3, read=0, status=0, other=0,
+                    backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10,
+                          max_retries=retries)
+    session.mount("https://", adapter)
+
+    return session
+
+def iterate_pages(dashboard, metadata, url, params):
+    """
+    Retrieve a paginated listing from the Meraki dashboard one page at a time,
+    following the next link returned with each page. The SDK's own iterator
+    is not used since it drops the last page
+    :return: generator yielding each item of each page
+    """
+    while url:
+        response = dashboard._session.request(metadata, "GET", url, params=params)
+        items = response.json()
+        url = response.links.get("next", {}).get("url")
+        params = None #the next link already carries the query parameters
+        response.close()
+
+        yield from items
+
+def fetch_all_networks(dashboard, org_id):
+    """
+    Connect to the Meraki dashboard and retrieve all the networks of the org
+    page by page, keeping only the id, name and product types of each network
+    :return: list containing the details of each of the networks in the org
+    """
+    metadata = {"tags": ["organizations", "configure", "networks"],
+                "operation": "getOrganizationNetworks"}
+    networks = iterate_pages(dashboard, metadata,
+                             f"/organizations/{org_id}/networks",
+                             {"perPage": 1000})
 
-    return None
+    return [{"id": network["id"], "name": network["name"],
+             "productTypes": network["productTypes"]} for network in networks]
 
-def get_wireless_networks(dashboard, org_id):
+def get_wireless_networks(networks):
     """
-    Connect to the Meraki dashboard and retrieve all the wireless networks in
-    the org
+    Iterate through the networks of the org and keep the wireless networks
     :return: list containing the details of each of the wireless networks
     """
-    networks = dashboard.organizations.getOrganizationNetworks(org_id,
-                                                               total_pages="all")
-    wireless_networks = []
-    for network in networks:
-        if "wireless" in network["productTypes"]:
-            wireless_networks.append(network)
+    wireless_networks = [network for network in networks
+                         if "wireless" in network["productTypes"]]
 
     return wireless_networks
 
-def get_all_ssids(dashboard, wireless_networks):
+async def fetch_net_ssids(aiomeraki, net):
+    """
+    Retrieve the SSIDs of a single wireless network
+    :return: tuple containing the network and the list of its SSIDs
+    """
+    ssids = await aiomeraki.wireless.getNetworkWirelessSsids(net["id"])
+
+    return net, ssids
+
+async def fetch_all_ssids(api_key, wireless_networks, progress, task):
     """
-    Iterate through the list of wireless networks and retrieve all the SSIDs
-    for each network. Add the SSIDs to a list if it is not an Unconfigured SSID
-    :return: list containing the details of the configured SSIDs
+    Concurrently retrieve the SSIDs of every wireless network, keeping at most
+    5 requests in flight to respect the Meraki per-org concurrency limit
+    :return: dictionary that maps the network id to the list of its SSIDs
+    """
+    net_ssids = {}
+    async with meraki.aio.AsyncDashboardAPI(api_key, suppress_logging=True,
+                                            maximum_retries=5,
+                                            wait_on_rate_limit=True,
+                                            maximum_concurrent_requests=5) as aiomeraki:
+        fetches = [fetch_net_ssids(aiomeraki, net) for net in wireless_networks]
+        for fetch in asyncio.as_completed(fetches):
+            net, ssids = await fetch
+            progress.console.print(f"Retrieved SSIDs for the {net['name']} network")
+            net_ssids[net["id"]] = ssids
+            progress.update(task, advance=1)
+
+    return net_ssids
+
+def get_all_ssids(api_key, wireless_networks):
+    """
+    Retrieve all the SSIDs for each of the wireless networks. Map the SSID name
+    to the details of the SSID if it is not an Unconfigured SSID
+    :return: tuple containing a dictionary with keys that are the names of the
+    configured SSIDs and the SSID details as the values, and a dictionary that
+    maps the network id to the list of all its SSIDs
     """
     total_nets = len(wireless_networks)
     with Progress() as progress:
         overall_progress = progress.add_task("Overall Progress",
                                              total=total_nets, transient=True)
-        all_ssids = []
-        for net in wireless_networks:
-            progress.console.print(f"Retrieving SSIDs for the {net['name']} network")
-            ssids = dashboard.wireless.getNetworkWirelessSsids(net["id"])
-            for ssid in ssids:
-                if not ssid["name"].startswith("Unconfigured"):
-                    all_ssids.append(ssid)
+        net_ssids = asyncio.run(fetch_all_ssids(api_key, wireless_networks,
+                                                progress, overall_progress))
 
-            progress.update(overall_progress, advance=1)
+    # keep the org's network order so the results do not depend on which
+    # request finished first
+    ssid_dict = {}
+    for net in wireless_networks:
+        for ssid in net_ssids[net["id"]]:
+            if not ssid["name"].startswith("Unconfigured"):
+                ssid_dict[ssid["name"]] = ssid
 
-    return all_ssids
+    return ssid_dict, net_ssids
 
-def make_ssid_dict(ssids):
+def load_cached_devices(org_id, net_ids):
     """
-    Iterate through the SSIDs and create a dictionary that maps the SSID name
-    to the details of the SSID
-    :return: dictionary with keys that are the names of the SSIDs and the SSID details as the values
+    Read the wireless devices saved by a previous run for the same org and
+    networks, if they were saved less than CACHE_EXPIRY seconds ago
+    :return: dictionary that maps the network id to the list of its wireless devices or None if there is no usable cache
     """
-    ssid_dict = {}
-    for ssid in ssids:
-        name = ssid["name"]
-        ssid_dict[name] = ssid
-
-    return ssid_dict
+    try:
+        with open(CACHE_PATH) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    # the cache file may have been edited or corrupted, so anything that does
+    # not look like a saved cache is ignored
+    if not isinstance(cache, dict) or not isinstance(cache.get("devices"), dict):
+        return None
+    if not all(isinstance(devices, list) and all(isinstance(device, dict) for device in devices)
+               for devices in cache["devices"].values()):
+        return None
+    if cache.get("org_id") != org_id or cache.get("net_ids") != sorted(net_ids):
+        return None
+    saved_at = cache.get("saved_at")
+    if not isinstance(saved_at, (int, float)) or time.time() - saved_at > CACHE_EXPIRY:
+        return None
+
+    return defaultdict(list, cache["devices"])
+
+def save_cached_devices(org_id, net_ids, net_devices):
+    """
+    Save the wireless devices of the networks so that runs within the next
+    CACHE_EXPIRY seconds do not need to retrieve them again
+    """
+    cache = {
+        "org_id": org_id,
+        "net_ids": sorted(net_ids),
+        "saved_at": time.time(),
+        "devices": net_devices
+    }
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with open(CACHE_PATH, "w") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as e:
+        print(f"There was an issue caching the AP tags for the following reason:")
+        print(e)
 
-def get_ap_ssids(dashboard, org_id, net_id, ssids):
+def get_network_devices(dashboard, org_id, net_ids):
+    """
+    Connect to the Meraki dashboard and retrieve the wireless devices of all
+    the given networks at once, page by page, then group them by network,
+    keeping only the tags of each device. Devices saved by a recent run are
+    reused instead
+    :return: dictionary that maps the network id to the list of its wireless devices
+    """
+    net_devices = load_cached_devices(org_id, net_ids)
+    if net_devices is not None:
+        return net_devices
+
+    metadata = {"tags": ["organizations", "configure", "devices"],
+                "operation": "getOrganizationDevices"}
+    devices = iterate_pages(dashboard, metadata,
+                            f"/organizations/{org_id}/devices",
+                            {"perPage": 1000, "networkIds[]": list(net_ids),
+                             "productTypes[]": ["wireless"]})
+    net_devices = defaultdict(list)
+    for device in devices:
+        net_devices[device["networkId"]].append({"tags": device.get("tags")})
+
+    # an empty result is more likely a bad read than networks without APs,
+    # so it is not cached
+    if net_devices:
+        save_cached_devices(org_id, net_ids, net_devices)
+
+    return net_devices
+
+def get_ap_ssids(devices, ssid_names):
     """
     Get all the AP tags in the network that correspond to existing SSID names
     :return: set of the AP tag names that correspond to existing SSID names
     """
-    total_ssids = len(ssids)
-    network_ssids = set()
-    with Progress() as progress:
-        overall_progress = progress.add_task("Overall Progress",
-                                             total=total_ssids, transient=True)
-        for ssid in ssids:
-            tag = ssid["name"]
-            progress.console.print(f"Retrieving all APs with the tag {tag}")
-            aps = dashboard.organizations.getOrganizationDevices(org_id,
-                                                                 total_pages="all",
-                                                                 networkIds=[net_id],
-                                                                 tags=[tag],
-                                                                 tagsFilterType="withAnyTags",
-                                                                 productTypes=["wireless"])
-            for ap in aps:
-                network_ssids.add(tag)
+    tags_in_network = set().union(*(device.get("tags") or [] for device in devices))
 
-            progress.update(overall_progress, advance=1)
+    return ssid_names & tags_in_network
 
-    return network_ssids
-
-def configure_net_ssids(dashboard, net_id, ssid_config):
+def configure_net_ssids(dashboard, net_id, ssid_config, console):
     """
     Configure an SSID in the network
-    :return: Boolean value indicating whether the SSID was successfully configured
+    :return: dictionary with the details of the configured SSID or None if the SSID could not be configured
     """
-    ssid_config["number"] = 3 #the SSID configured will always be the 4th SSID (0-based index)
-    ssid_num = ssid_config.pop("number")
+    ssid_config.pop("number", None)
     try:
-        response = dashboard.wireless.updateNetworkWirelessSsid(net_id, ssid_num,
+        response = dashboard.wireless.updateNetworkWirelessSsid(net_id, SSID_NUMBER,
                                                                 **ssid_config)
-        return True
+        return response
     except Exception as e:
-        print(f"There was an issue configuring the SSID {ssid_config['name']} for the following reason:")
-        print(e)
+        console.log(f"There was an issue configuring the SSID {ssid_config['name']} for the following reason:")
+        console.log(e)
 
-        return False
+        return None
 
-def get_psk_net_ssids(dashboard, net_id):
+def ssid_is_configured(current_ssid, ssid_config):
+    """
+    Compare the SSID currently in the network with the SSID configuration to
+    apply, ignoring the SSID number
+    :return: Boolean value indicating whether the SSID already has the configuration
     """
-    Connect to the Meraki dashboard and retrieve all the SSIDs that have a PSK
-    configured as the auth mode
+    return all(current_ssid.get(key) == value for key, value in ssid_config.items()
+               if key != "number")
+
+def configure_network(dashboard, net_id, net_ssids, ssid_configs, progress, task):
+    """
+    Configure each of the given SSIDs in the network in turn, advancing the
+    progress bar after each one. SSIDs that already match the SSID in the
+    network are skipped. Each SSID configuration is copied so that the same
+    SSID can be configured in several networks at once
+    :return: list of tuples containing the SSID name, the configured SSID or None if it could not be configured, and whether an update was made
+    """
+    current_ssid = next((ssid for ssid in net_ssids if ssid["number"] == SSID_NUMBER), None)
+    results = []
+    for ssid_name, ssid_config in ssid_configs:
+        if current_ssid is not None and ssid_is_configured(current_ssid, ssid_config):
+            results.append((ssid_name, current_ssid, False))
+        else:
+            configured_ssid = configure_net_ssids(dashboard, net_id, dict(ssid_config),
+                                                  progress.console)
+            if configured_ssid:
+                current_ssid = configured_ssid
+
+            results.append((ssid_name, configured_ssid, True))
+
+        progress.update(task, advance=1)
+
+    return results
+
+def get_psk_net_ssids(ssids_by_net, net_id):
+    """
+    Find all the SSIDs of the network that have a PSK configured as the auth
+    mode, using the SSIDs already retrieved from the Meraki dashboard
     :return: list containing the name and number of the PSK SSIDs
     """
     psk_ssids = []
-    ssids = dashboard.wireless.getNetworkWirelessSsids(net_id)
-    for ssid in ssids:
+    for ssid in ssids_by_net.get(net_id, []):
         if ssid["authMode"] == "psk":
             psk_ssid = {
                 "name": ssid["name"],
@@ -168,47 +332,64 @@ def main(argv):
     # retrieve the environmental variables
     load_dotenv()
     API_KEY = os.getenv("API_KEY")
-    NET_NAMES = json.loads(os.getenv("NETWORK_NAMES"))
+    NET_NAMES = parse_network_names(os.getenv("NETWORK_NAMES"))
     ORG_ID = os.getenv("ORG_ID")
+    if NET_NAMES is None:
+        print("NETWORK_NAMES must be a list of network names in double quotes, such as [\"network 1\", \"network 2\"]")
+        print("Aborting program...")
+
+        return
 
     console = Console()
     console.print(Panel.fit(f"Meraki AP SSID Configuration"))
 
     # connect to the Meraki dashboard
     console.print(Panel.fit(f"Connect to Meraki dashboard", title="Step 1"))
-    dashboard = meraki.DashboardAPI(API_KEY, suppress_logging=True)
-
-    # find the network id corresponding to the network name given in the environmental variables
+    # on a 429 the SDK waits for the duration given in the Retry-After header
+    dashboard = meraki.DashboardAPI(API_KEY, suppress_logging=True,
+                                    maximum_retries=5, wait_on_rate_limit=True)
+    configure_session(dashboard)
+
+    # retrieve the networks of the Meraki organization once and look up the
+    # network ids corresponding to the network names given in the environmental variables
+    console.print(Panel.fit(f"Get network IDs for networks {', '.join(sorted(NET_NAMES))}",
+                            title="Step 2"))
+    networks = fetch_all_networks(dashboard, ORG_ID)
+    # like the dashboard lookup, the first network with a matching name is used
     net_id_to_name = {}
-    for network in NET_NAMES:
-        console.print(Panel.fit(f"Get network ID for network {network}", title="Step 2"))
-        net_id = get_network_id(dashboard, ORG_ID, network)
-        if net_id is None:
-            print(f"There was an error trying to find the network with name {network}")
-            print("Aborting program...")
-
-            return
+    found_names = set()
+    for network in networks:
+        if network["name"] in NET_NAMES and network["name"] not in found_names:
+            net_id_to_name[network["id"]] = network["name"]
+            found_names.add(network["name"])
 
-        net_id_to_name[net_id] = network
+    missing_names = NET_NAMES - found_names
+    for network in sorted(missing_names):
+        print(f"There was an error trying to find the network with name {network}")
+    if missing_names:
+        print("Aborting program...")
 
+        return
 
     # retrieve all the wireless networks in the Meraki organization
     console.print(Panel.fit(f"Get all wireless networks from the Meraki organization",
                             title="Step 3"))
-    wireless_networks = get_wireless_networks(dashboard, ORG_ID)
+    wireless_networks = get_wireless_networks(networks)
 
     # retrieve all the configured SSIDs from  the Meraki organization
     console.print(Panel.fit(f"Retrieve all the SSIDs from the Meraki organization",
                             title="Step 4"))
-    all_ssids = get_all_ssids(dashboard, wireless_networks)
-    ssid_dict = make_ssid_dict(all_ssids)
+    ssid_dict, ssids_by_net = get_all_ssids(API_KEY, wireless_networks)
 
     # retrieve all the SSID names that correspond to the AP tags
     console.print(Panel.fit(f"Find which SSIDs need to be configured by AP tags",
                             title="Step 5"))
+    console.print("Retrieving the APs of the networks")
+    net_devices = get_network_devices(dashboard, ORG_ID, net_id_to_name)
+    ssid_names = set(ssid_dict)
     network_to_ssids = {}
     for net_id in net_id_to_name:
-        network_to_ssids[net_id] = get_ap_ssids(dashboard, ORG_ID, net_id, all_ssids)
+        network_to_ssids[net_id] = get_ap_ssids(net_devices[net_id], ssid_names)
 
     # configure the SSIDs that match AP tags in the network
     console.print(Panel.fit(f"Configure networks with the necessary SSIDs",
@@ -217,29 +398,46 @@ def main(argv):
     for network in network_to_ssids:
         total_ssids += len(network_to_ssids[network])
 
-    with Progress() as progress:
+    # networks are configured in parallel, but the SSIDs of a network are
+    # configured one after another since they all target the same SSID number
+    with Progress(console=console) as progress:
         overall_progress = progress.add_task("Overall Progress", total=total_ssids,
                                              transient=True)
-        for net_id in network_to_ssids:
-            progress.console.print(f"Configuring the SSIDs of the {net_id_to_name[net_id]} network")
-            for ssid_name in network_to_ssids[net_id]:
-                ssid = ssid_dict[ssid_name]
-                configured = configure_net_ssids(dashboard, net_id, ssid)
-                if configured:
-                    print(f"{net_id_to_name[net_id]} configured with ssid {ssid_name}")
-                else:
-                    print(f"There was an issue configuring ssid {ssid_name} on {net_id_to_name[net_id]}")
-
-                progress.update(overall_progress, advance=1)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = {}
+            for net_id in network_to_ssids:
+                progress.console.print(f"Configuring the SSIDs of the {net_id_to_name[net_id]} network")
+                ssid_configs = [(ssid_name, ssid_dict[ssid_name])
+                                for ssid_name in network_to_ssids[net_id]]
+                future = executor.submit(configure_network, dashboard, net_id,
+                                         ssids_by_net.get(net_id, []), ssid_configs,
+                                         progress, overall_progress)
+                futures[future] = net_id
+
+            for future in as_completed(futures):
+                net_id = futures[future]
+                for ssid_name, configured_ssid, updated in future.result():
+                    if not updated:
+                        progress.console.log(f"{net_id_to_name[net_id]} already configured with ssid {ssid_name}")
+                    elif configured_ssid:
+                        progress.console.log(f"{net_id_to_name[net_id]} configured with ssid {ssid_name}")
+                        # keep the retrieved SSIDs in line with the network for Step 7
+                        ssids_by_net[net_id] = [configured_ssid if ssid["number"] == configured_ssid["number"] else ssid
+                                                for ssid in ssids_by_net.get(net_id, [])]
+                    else:
+                        progress.console.log(f"There was an issue configuring ssid {ssid_name} on {net_id_to_name[net_id]}")
 
     # provide the user an option to change the PSK on the SSIDs in the network with PSKs
     console.print(Panel.fit(f"Configure new passwords on SSIDs", title="Step 7"))
     psk_ssids = []
+    seen = set()
     for net_id in network_to_ssids:
-        psk_ssids += get_psk_net_ssids(dashboard, net_id)
+        for ssid in get_psk_net_ssids(ssids_by_net, net_id):
+            if (ssid["net_id"], ssid["number"]) not in seen:
+                seen.add((ssid["net_id"], ssid["number"]))
+                psk_ssids.append(ssid)
 
-    for ssid in psk_ssids:
-        index = psk_ssids.index(ssid)
+    for index, ssid in enumerate(psk_ssids):
         net_name = net_id_to_name[ssid["net_id"]]
         print(f"{index} - {ssid['name']} of {net_name}")
 